@@ -1,14 +1,16 @@
 # streamlit_app.py
 
 import os
+import openai
 import streamlit as st
 from dotenv import load_dotenv
 from utils.utils import (
     extract_text_pdfminer,
-    chunk_text,
+    chunk_text_tokens,
     embed_chunks,
     build_and_save_faiss,
     load_faiss,
+    load_chunk_filters,
     retrieve,
     ask_llm,
     cache_history,
@@ -29,6 +31,8 @@ BOOK_PATH1  = "NBC 2016-VOL.1.pdf.pdf"
 BOOK_PATH2  = "NBC 2016-VOL.2.pdf.pdf"
 INDEX_PATH  = "faiss.index"
 META_PATH   = "chunks.pkl"
+FILTER_PATH = "chunk_filters.npz"
+LATENCY_SLO = 30.0  # Seconds allowed for generating an answer
 
 st.set_page_config(
     page_title="PDF Chatbot",
@@ -43,13 +47,13 @@ def init_faiss():
     try:
         if not (os.path.exists(INDEX_PATH) and os.path.exists(META_PATH)):
             # Extract and process text
-            text = extract_text_pdfminer([BOOK_PATH1, BOOK_PATH2])
+            text, page_spans = extract_text_pdfminer([BOOK_PATH1, BOOK_PATH2], return_pages=True)
             if not text:
                 st.error("Failed to extract text from PDF. Please check if the file is valid.")
                 return None, None
                 
             # Create chunks
-            chunks = chunk_text(text)
+            chunks = chunk_text_tokens(text, page_spans=page_spans)
             if not chunks:
                 st.error("Failed to create text chunks. The PDF may be empty or invalid.")
                 return None, None
@@ -62,7 +66,7 @@ def init_faiss():
                 
             # Build FAISS index
             try:
-                build_and_save_faiss(embs, chunks)
+                build_and_save_faiss(embs, chunks, INDEX_PATH, META_PATH, FILTER_PATH)
             except ValueError as e:
                 st.error(f"Failed to build FAISS index: {str(e)}")
                 return None, None
@@ -73,10 +77,15 @@ def init_faiss():
         st.error(f"An error occurred during initialization: {str(e)}")
         return None, None
 
+@st.cache_resource
+def init_filters(_chunks):
+    return load_chunk_filters(FILTER_PATH, _chunks)
+
 # Initialize FAISS index
 index, chunks = init_faiss()
 if not index or not chunks:
     st.stop()  # Stop execution if initialization failed
+filters = init_filters(chunks)
 
 # ─── SESSION STATE ─────────────────────────────────────────────────────────────
 # if "history" not in st.session_state:
@@ -153,6 +162,22 @@ with st.sidebar:
         </div>
     """, unsafe_allow_html=True)
     
+    with st.expander("🔎 Search Filters"):
+        tables_only = st.checkbox("Tables only")
+        source = st.selectbox("Volume", ["All"] + filters['sources'])
+        # Offer the page range actually covered by the selected volume
+        page_mask = filters['pages'] >= 1
+        if source != "All":
+            page_mask &= filters['source_ids'] == filters['sources'].index(source)
+        page_range = full_page_range = None
+        if page_mask.any():
+            full_page_range = (int(filters['pages'][page_mask].min()),
+                               int(filters['last_pages'][page_mask].max()))
+            if full_page_range[0] < full_page_range[1]:
+                page_range = st.slider("Pages", *full_page_range, full_page_range)
+        else:
+            st.caption("Rebuild the index to filter by volume or page.")
+
     with st.container():
         st.markdown('<div class="clear-button">', unsafe_allow_html=True)
         if st.button("🗑️ Clear History", type="secondary", use_container_width=True):
@@ -262,11 +287,22 @@ def process_query(question):
     
     with st.spinner('Thinking... 🤔'):
         # Retrieve & answer
-        ctx = retrieve(question, index, chunks)
+        where = {}
+        if tables_only:
+            where['contains_table'] = True
+        if source != "All":
+            where['source'] = source
+        if page_range and page_range != full_page_range:
+            where['pages'] = page_range
+        ctx, dists = retrieve(question, index, chunks, where=where, filters=filters,
+                              return_distances=True)
         if not ctx:
             answer = "_Sorry, I couldn't find relevant info._"
         else:
-            answer = ask_llm(ctx, question)
+            try:
+                answer = ask_llm(ctx, question, distances=dists, latency_slo=LATENCY_SLO)
+            except (openai.error.OpenAIError, ValueError) as e:
+                answer = f"_Sorry, I couldn't generate an answer: {e}_"
         # Cache
         cache_history(question, answer)
         
@@ -0,0 +1,97 @@
+import os
+import sys
+
+import pytest
+import tiktoken
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import utils
+
+
+@pytest.fixture(autouse=True)
+def encoding(monkeypatch):
+    # Byte-level encoding: multi-byte characters span several tokens, and no
+    # tokenizer files are downloaded
+    ranks = {bytes([i]): i for i in range(256)}
+    encoding = tiktoken.Encoding("bytes", pat_str=r"\S+|\s+", mergeable_ranks=ranks, special_tokens={})
+    monkeypatch.setattr(utils, "get_encoding", lambda model=None: encoding)
+    return encoding
+
+
+MULTIBYTE_TEXT = "".join(
+    f"Clause {i}: fee ₹{i * 10}, rated at {i}°C for the café résumé. " * (1 + i % 4) + "\n"
+    for i in range(120)
+)
+
+
+def check_chunks(text, chunks, chunk_tokens):
+    assert chunks
+    for chunk in chunks:
+        meta = chunk['metadata']
+        assert chunk['content'] == text[meta['start_char']:meta['end_char']]
+        assert "�" not in chunk['content']
+        assert 0 < meta['token_count'] <= chunk_tokens
+
+    # Together the chunks cover the whole text, without gaps
+    assert chunks[0]['metadata']['start_char'] == 0
+    assert chunks[-1]['metadata']['end_char'] == len(text)
+    for prev, nxt in zip(chunks, chunks[1:]):
+        assert nxt['metadata']['start_char'] < prev['metadata']['end_char']
+
+
+@pytest.mark.parametrize("chunk_tokens,overlap", [(256, 50), (40, 10), (7, 2)])
+def test_multibyte_text_is_never_split(chunk_tokens, overlap):
+    chunks = utils.chunk_text_tokens(MULTIBYTE_TEXT, chunk_tokens, overlap, min_chunk_tokens=1)
+
+    check_chunks(MULTIBYTE_TEXT, chunks, chunk_tokens)
+
+
+def test_chunks_overlap_by_requested_tokens():
+    text = "x" * 1000  # No line breaks to snap to
+
+    chunks = utils.chunk_text_tokens(text, chunk_tokens=256, overlap=50, min_chunk_tokens=25)
+
+    check_chunks(text, chunks, 256)
+    for prev, nxt in zip(chunks, chunks[1:]):
+        assert prev['metadata']['end_char'] - nxt['metadata']['start_char'] == 50
+
+
+def test_short_tail_is_not_dropped():
+    text = "a" * 235 + "\n" + "b" * 19 + "\nEND"
+
+    chunks = utils.chunk_text_tokens(text, chunk_tokens=256, overlap=50, min_chunk_tokens=25)
+
+    check_chunks(text, chunks, 256)
+    assert chunks[-1]['content'].endswith("END")
+    assert chunks[-1]['metadata']['token_count'] >= 25
+
+
+def test_chunks_record_pages():
+    spans = [{'source': 'a.pdf', 'page': p + 1, 'start_char': p * 1000} for p in range(len(MULTIBYTE_TEXT) // 1000 + 1)]
+
+    chunks = utils.chunk_text_tokens(MULTIBYTE_TEXT, page_spans=spans)
+
+    for chunk in chunks:
+        meta = chunk['metadata']
+        assert meta['page'] == meta['start_char'] // 1000 + 1
+        assert meta['last_page'] == (meta['end_char'] - 1) // 1000 + 1
+
+
+def test_chunk_token_counts_only_encodes_missing(monkeypatch, encoding):
+    encoded = []
+
+    class CountingEncoding:
+        def encode_ordinary_batch(self, texts, **kwargs):
+            encoded.extend(texts)
+            return encoding.encode_ordinary_batch(texts, **kwargs)
+
+    monkeypatch.setattr(utils, "get_encoding", lambda model=None: CountingEncoding())
+    chunks = [
+        {'content': "stored", 'metadata': {'token_count': 99}},
+        {'content': "no count", 'metadata': {}},
+        {'content': "no metadata"},
+    ]
+
+    assert utils.chunk_token_counts(chunks) == [99, 8, 11]
+    assert encoded == ["no count", "no metadata"]
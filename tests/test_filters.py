@@ -0,0 +1,157 @@
+import os
+import sys
+
+import faiss
+import numpy as np
+import openai
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import utils
+
+DIM = 8
+
+
+def make_chunks():
+    """Two volumes of ten pages, two chunks per page, every third chunk a table."""
+    chunks = []
+    for source in ("VOL.1.pdf", "VOL.2.pdf"):
+        for page in range(1, 11):
+            for half in range(2):
+                i = len(chunks)
+                chunks.append({
+                    'content': f"chunk {i}",
+                    'metadata': {
+                        'chunk_id': i,
+                        'source': source,
+                        'page': page,
+                        # The second chunk of each page runs onto the next one
+                        'last_page': page + half if page < 10 else page,
+                        'contains_table': i % 3 == 0,
+                        'contains_list': i % 5 == 0,
+                        'is_header': False,
+                    }
+                })
+    return chunks
+
+
+@pytest.fixture
+def corpus(monkeypatch):
+    rng = np.random.default_rng(0)
+    chunks = make_chunks()
+    vectors = rng.random((len(chunks), DIM), dtype="float32")
+    query = rng.random(DIM, dtype="float32")
+
+    index = faiss.IndexFlatL2(DIM)
+    index.add(vectors)
+    monkeypatch.setattr(openai.Embedding, "create",
+                        lambda **kwargs: {"data": [{"embedding": query.tolist()}]})
+    return index, chunks, vectors, query, utils.build_chunk_filters(chunks)
+
+
+def brute_force(vectors, query, mask, top_k):
+    ids = np.flatnonzero(mask)
+    dists = ((vectors[ids] - query) ** 2).sum(axis=1)
+    return ids[np.argsort(dists)][:top_k].tolist()
+
+
+def ids_of(chunks):
+    return [c['metadata']['chunk_id'] for c in chunks]
+
+
+@pytest.mark.parametrize("where", [
+    {'contains_table': True},
+    {'contains_list': False},
+    {'source': 'VOL.2.pdf'},
+    {'source': ['VOL.1.pdf', 'VOL.2.pdf'], 'contains_table': True},
+    {'pages': (3, 5)},
+    {'source': 'VOL.2.pdf', 'pages': (4, 6)},
+])
+def test_filtered_search_matches_brute_force(corpus, where):
+    index, chunks, vectors, query, filters = corpus
+
+    found, dists = utils.retrieve("q", index, chunks, top_k=5, where=where,
+                                  filters=filters, return_distances=True)
+
+    mask = utils.filter_mask(filters, where)
+    assert ids_of(found) == brute_force(vectors, query, mask, 5)
+    assert dists == sorted(dists)
+
+
+def test_filter_mask_flags_sources_and_pages(corpus):
+    filters = corpus[4]
+
+    tables = utils.filter_mask(filters, {'contains_table': True})
+    assert np.flatnonzero(tables).tolist() == list(range(0, 40, 3))
+
+    vol2 = utils.filter_mask(filters, {'source': 'VOL.2.pdf'})
+    assert np.flatnonzero(vol2).tolist() == list(range(20, 40))
+
+    # Page 4's chunks plus the chunk that starts on page 3 and runs onto page 4
+    pages = utils.filter_mask(filters, {'source': 'VOL.2.pdf', 'pages': (4, 4)})
+    assert np.flatnonzero(pages).tolist() == [25, 26, 27]
+
+
+def test_filter_mask_rejects_bad_expressions(corpus):
+    filters = corpus[4]
+
+    with pytest.raises(ValueError, match="Unknown filter key"):
+        utils.filter_mask(filters, {'colour': 'red'})
+    with pytest.raises(ValueError, match="Unknown source"):
+        utils.filter_mask(filters, {'source': 'VOL.3.pdf'})
+    for pages in [(5,), (7, 3), "1-3", (1.5, 2)]:
+        with pytest.raises(ValueError, match="page range"):
+            utils.filter_mask(filters, {'pages': pages})
+
+
+def test_bitmap_is_little_endian():
+    mask = np.zeros(20, dtype=bool)
+    mask[[0, 3, 9, 17]] = True
+    bitmap = np.packbits(mask, bitorder="little")
+    selector = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap))
+
+    assert [i for i in range(20) if selector.is_member(i)] == [0, 3, 9, 17]
+
+
+def test_drops_padding_when_few_ids_match(corpus):
+    index, chunks, vectors, query, filters = corpus
+    where = {'source': 'VOL.1.pdf', 'pages': (10, 10)}
+
+    found, dists = utils.retrieve("q", index, chunks, top_k=5, where=where,
+                                  filters=filters, return_distances=True)
+
+    # Page 10's two chunks plus the one running onto it from page 9
+    assert sorted(ids_of(found)) == [17, 18, 19]
+    assert len(dists) == 3
+
+
+def test_filtered_search_needs_filters(corpus):
+    index, chunks = corpus[:2]
+
+    with pytest.raises(ValueError):
+        utils.retrieve("q", index, chunks, where={'contains_table': True})
+
+
+def test_load_chunk_filters_rebuilds_on_mismatch(tmp_path):
+    chunks = make_chunks()
+    path = str(tmp_path / "chunk_filters.npz")
+    utils.save_chunk_filters(utils.build_chunk_filters(chunks[:10]), path)
+
+    filters = utils.load_chunk_filters(path, chunks)
+
+    assert len(filters['flags']) == len(chunks)
+    assert filters['sources'] == ['VOL.1.pdf', 'VOL.2.pdf']
+    # The rebuilt filters were saved back
+    assert len(utils.load_chunk_filters(path)['flags']) == len(chunks)
+
+
+def test_chunk_pages_spans_page_break():
+    spans = [{'source': 'a.pdf', 'page': p, 'start_char': (p - 1) * 100} for p in range(1, 4)]
+    spans.append({'source': 'b.pdf', 'page': 1, 'start_char': 300})
+    starts = [s['start_char'] for s in spans]
+
+    assert utils.chunk_pages(spans, starts, 150, 250) == {'source': 'a.pdf', 'page': 2, 'last_page': 3}
+    assert utils.chunk_pages(spans, starts, 120, 200) == {'source': 'a.pdf', 'page': 2, 'last_page': 2}
+    assert utils.chunk_pages(spans, starts, 250, 350) == {'source': 'a.pdf', 'page': 3, 'last_page': 3}
+    assert utils.chunk_pages([], [], 0, 10) == {'source': None, 'page': None, 'last_page': None}
@@ -0,0 +1,209 @@
+import json
+import os
+import sys
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+import pytest
+import tiktoken
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import utils
+
+
+def start_stub(delay: float, status: int = 200):
+    """Start a local chat-completions endpoint that answers after `delay` seconds."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            time.sleep(delay)
+            if status == 200:
+                payload = {
+                    "id": "stub",
+                    "object": "chat.completion",
+                    "choices": [{"index": 0, "message": {"role": "assistant",
+                                                         "content": f" answered by {body['model']} "}}],
+                    "usage": {"prompt_tokens": 12, "completion_tokens": 3},
+                }
+            else:
+                payload = {"error": {"message": "stub failure", "type": "server_error"}}
+            out = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            try:
+                self.wfile.write(out)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # The client already gave up on a slow stub
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/v1"
+
+
+@pytest.fixture(scope="module")
+def endpoints():
+    stubs = {
+        "fast": start_stub(0.05),
+        "slow": start_stub(3.0),
+        "broken": start_stub(0.0, status=500),
+    }
+    yield {name: url for name, (_, url) in stubs.items()}
+    for server, _ in stubs.values():
+        server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    # Byte-level encoding so no tokenizer files are downloaded
+    ranks = {bytes([i]): i for i in range(256)}
+    encoding = tiktoken.Encoding("bytes", pat_str=r"\S+|\s+", mergeable_ranks=ranks, special_tokens={})
+    monkeypatch.setattr(utils, "get_encoding", lambda model=None: encoding)
+    monkeypatch.setattr(utils, "TIER_METRICS", {})
+    monkeypatch.setattr(openai, "api_key", "test")
+
+
+def make_tiers(fast_base, quality_base):
+    return [
+        {"name": "fast", "model": "gpt-3.5-turbo", "max_prompt_tokens": 3000,
+         "expected_latency": 0.5, "timeout": 10.0, "api_base": fast_base},
+        {"name": "quality", "model": "gpt-4", "max_prompt_tokens": 7000,
+         "expected_latency": 1.0, "timeout": 60.0, "api_base": quality_base},
+    ]
+
+
+CHUNKS = [{"content": "Fire exits shall be 1.5 m wide.", "metadata": {"token_count": 10}}]
+
+
+def test_routes_by_confidence_and_slo(endpoints):
+    tiers = make_tiers(endpoints["fast"], endpoints["fast"])
+
+    assert utils.route_model(100, [0.2], None, tiers)[0]["name"] == "fast"
+    assert utils.route_model(100, [1.5], None, tiers)[0]["name"] == "quality"
+    # Too tight an SLO for the quality tier
+    assert utils.route_model(100, [1.5], 0.8, tiers)[0]["name"] == "fast"
+    # Too big for the fast tier's window
+    assert [t["name"] for t in utils.route_model(5000, [0.2], None, tiers)] == ["quality"]
+
+    assert utils.ask_llm(CHUNKS, "How wide?", distances=[0.2], tiers=tiers) == "answered by gpt-3.5-turbo"
+    assert utils.ask_llm(CHUNKS, "How wide?", distances=[1.5], tiers=tiers) == "answered by gpt-4"
+
+
+def test_falls_back_on_timeout_within_slo(endpoints):
+    tiers = make_tiers(endpoints["fast"], endpoints["slow"])
+
+    start = time.monotonic()
+    answer = utils.ask_llm(CHUNKS, "How wide?", distances=[1.5], latency_slo=2.0, tiers=tiers)
+
+    assert answer == "answered by gpt-3.5-turbo"
+    assert time.monotonic() - start < 2.0
+    assert utils.TIER_METRICS["quality"]["calls"] == 1
+    assert utils.TIER_METRICS["quality"]["timeouts"] == 1
+
+
+def test_falls_back_on_server_error(endpoints):
+    tiers = make_tiers(endpoints["fast"], endpoints["broken"])
+
+    answer = utils.ask_llm(CHUNKS, "How wide?", distances=[1.5], tiers=tiers)
+
+    assert answer == "answered by gpt-3.5-turbo"
+    assert utils.TIER_METRICS["quality"]["errors"] == 1
+    assert utils.TIER_METRICS["quality"]["timeouts"] == 0
+
+
+def test_records_tier_metrics(endpoints):
+    tiers = make_tiers(endpoints["fast"], endpoints["slow"])
+
+    for _ in range(2):
+        utils.ask_llm(CHUNKS, "How wide?", distances=[0.2], tiers=tiers)
+    utils.ask_llm(CHUNKS, "How wide?", distances=[1.5], latency_slo=2.0, tiers=tiers)
+
+    fast = utils.TIER_METRICS["fast"]
+    quality = utils.TIER_METRICS["quality"]
+    assert fast["calls"] == 3
+    assert fast["timeouts"] == 0
+    assert fast["prompt_tokens"] == 3 * 12
+    assert fast["completion_tokens"] == 3 * 3
+    assert 0 < fast["max_latency"] <= fast["total_latency"]
+    assert quality["calls"] == 1
+    assert quality["timeouts"] == 1
+    assert quality["completion_tokens"] == 0
+
+
+def test_context_trimmed_to_largest_tier(endpoints):
+    tiers = make_tiers(endpoints["fast"], endpoints["fast"])
+    chunks = [{"content": f"chunk {i}", "metadata": {"token_count": 2000}} for i in range(5)]
+
+    # 10000 context tokens would not fit any tier without trimming
+    assert utils.ask_llm(chunks, "How wide?", distances=[1.5], tiers=tiers) == "answered by gpt-4"
+    assert utils.TIER_METRICS["quality"]["calls"] == 1
+
+
+def default_tiers(fast_base, quality_base):
+    tiers = [dict(tier) for tier in utils.MODEL_TIERS]
+    tiers[0]["api_base"], tiers[1]["api_base"] = fast_base, quality_base
+    return tiers
+
+
+def record_timeouts(monkeypatch):
+    """Make every tier use up its timeout on a fake clock, recording the
+    timeout each model was given."""
+    given = {}
+    clock = types.SimpleNamespace(now=0.0)
+    clock.monotonic = lambda: clock.now
+
+    def create(model, request_timeout, **kwargs):
+        given[model] = request_timeout
+        clock.now += request_timeout
+        raise openai.error.Timeout("stub timeout")
+
+    monkeypatch.setattr(utils, "time", clock)
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    return given
+
+
+@pytest.mark.parametrize("distance", [0.2, 1.5])
+def test_fast_tier_keeps_its_latency_under_tight_slo(monkeypatch, distance):
+    # gpt-4 cannot finish within 10s, so nothing is held back for it
+    given = record_timeouts(monkeypatch)
+    tiers = default_tiers(None, None)
+
+    with pytest.raises(openai.error.Timeout):
+        utils.ask_llm(CHUNKS, "How wide?", distances=[distance], latency_slo=10.0, tiers=tiers)
+
+    assert given["gpt-3.5-turbo"] == 10.0
+    assert "gpt-4" not in given
+
+
+def test_primary_leaves_budget_for_fallback_that_fits(monkeypatch):
+    given = record_timeouts(monkeypatch)
+    tiers = default_tiers(None, None)
+
+    with pytest.raises(openai.error.Timeout):
+        utils.ask_llm(CHUNKS, "How wide?", distances=[1.5], latency_slo=30.0, tiers=tiers)
+
+    # gpt-4 gets all but gpt-3.5-turbo's expected 3s, which the fallback then uses
+    assert given["gpt-4"] == 27.0
+    assert given["gpt-3.5-turbo"] == 3.0
+
+
+def test_fast_tier_answers_within_real_latencies(endpoints):
+    # A 2s answer is within the fast tier's expected 3s
+    slowish, url = start_stub(2.0)
+    try:
+        tiers = default_tiers(url, endpoints["fast"])
+        answer = utils.ask_llm(CHUNKS, "How wide?", distances=[0.2], latency_slo=10.0, tiers=tiers)
+    finally:
+        slowish.shutdown()
+
+    assert answer == "answered by gpt-3.5-turbo"
+    assert utils.TIER_METRICS["fast"]["timeouts"] == 0
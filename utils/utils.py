@@ -4,6 +4,8 @@
 import re
 # import pdfplumber
 import os
+import bisect
+from typing import Union
 import openai
 from pdfminer.high_level import extract_text_to_fp
 from pdfminer.layout import LAParams
@@ -79,19 +81,23 @@ if 'HTTPS_PROXY' in os.environ: del os.environ['HTTPS_PROXY']
 #         output.close()
 
 
-def extract_text_pdfminer(pdf_paths, encoding='utf-8'):
+def extract_text_pdfminer(pdf_paths, encoding='utf-8', return_pages=False):
     """
     Extract and combine text from multiple PDF files using pdfminer.six.
 
     Args:
         pdf_paths (list[str]): List of PDF file paths.
         encoding (str): Text encoding to use (default: utf-8)
+        return_pages (bool): Also return the page spans of the combined text
 
     Returns:
-        str: Combined cleaned text from all PDFs
+        str: Combined cleaned text from all PDFs. If return_pages is True,
+        a (text, page_spans) tuple where page_spans is a list of dicts with
+        'source', 'page' (1-based) and 'start_char' for every page.
     """
     try:
         full_text = ""
+        page_spans = []
 
         laparams = LAParams(
             line_margin=0.5,
@@ -115,17 +121,37 @@ def extract_text_pdfminer(pdf_paths, encoding='utf-8'):
             text = output.getvalue()
             output.close()
 
-            cleaned_text = "\n".join(
-                line.strip() for line in text.splitlines()
-                if line.strip()
-            )
+            # pdfminer ends every page with a form feed; clean page by page
+            # so each page's offset in the combined text can be recorded
+            cleaned_pages = []
+            offset = len(full_text)
+            for page_no, page_text in enumerate(text.split("\f"), start=1):
+                cleaned_page = "\n".join(
+                    line.strip() for line in page_text.splitlines()
+                    if line.strip()
+                )
+                if not cleaned_page:
+                    continue
+                page_spans.append({
+                    'source': os.path.basename(pdf_path),
+                    'page': page_no,
+                    'start_char': offset
+                })
+                cleaned_pages.append(cleaned_page)
+                offset += len(cleaned_page) + 1
+
+            cleaned_text = "\n".join(cleaned_pages)
 
             full_text += cleaned_text + "\n"
 
+        if return_pages:
+            return full_text, page_spans
         return full_text
 
     except Exception as e:
         print(f"Error extracting text from PDFs: {str(e)}")
+        if return_pages:
+            return "", []
         return ""
 
 # Step 2: Chunk into Overlapping Windows
@@ -134,7 +160,8 @@ def extract_text_pdfminer(pdf_paths, encoding='utf-8'):
 def chunk_text(text: str,
                chunk_size: int = 1000,
                overlap: int = 200,
-               min_chunk_size: int = 100) -> list[dict]:
+               min_chunk_size: int = 100,
+               page_spans: list[dict] = None) -> list[dict]:
     """
     Chunk text into semantically meaningful segments with metadata.
     
@@ -143,6 +170,8 @@ def chunk_text(text: str,
         chunk_size (int): Maximum size of each chunk
         overlap (int): Number of characters to overlap between chunks
         min_chunk_size (int): Minimum size for any chunk
+        page_spans (list[dict]): Page spans from extract_text_pdfminer, used
+            to tag each chunk with its 'source' file and first/last page
         
     Returns:
         list[dict]: List of chunks with metadata
@@ -161,8 +190,11 @@ def chunk_text(text: str,
     # Get raw chunks
     raw_chunks = splitter.split_text(text)
     
+    page_starts = [span['start_char'] for span in page_spans or []]
+    
     # Process chunks and add metadata
     processed_chunks = []
+    search_from = 0
     for i, chunk in enumerate(raw_chunks):
         # Clean the chunk
         chunk = chunk.strip()
@@ -171,26 +203,175 @@ def chunk_text(text: str,
         if len(chunk) < min_chunk_size:
             continue
             
+        # Chunks come in text order, so search past the previous one; a plain
+        # find() would tag repeated boilerplate with its first page
+        start_char = text.find(chunk, search_from)
+        if start_char == -1:
+            start_char = text.find(chunk)
+        else:
+            search_from = start_char + 1
+            
         # Create chunk with metadata
         chunk_dict = {
             'content': chunk,
             'metadata': {
                 'chunk_id': i,
                 'char_length': len(chunk),
-                'start_char': text.find(chunk),
-                'end_char': text.find(chunk) + len(chunk),
-                # Detect if chunk contains special sections
-                'contains_table': bool(re.search(r'table|figure|fig\.', chunk.lower())),
-                'contains_list': bool(re.search(r'^\s*[-•*]\s|^\s*\d+\.\s', chunk, re.MULTILINE)),
-                'is_header': bool(re.search(r'^[A-Z\s]{5,}$', chunk, re.MULTILINE))
+                'start_char': start_char,
+                'end_char': start_char + len(chunk),
+                **chunk_pages(page_spans, page_starts, start_char, start_char + len(chunk)),
+                **detect_sections(chunk)
             }
         }
         
         processed_chunks.append(chunk_dict)
     
+    # Count tokens for all chunks in one batched pass so that embedding
+    # and prompt building never have to re-tokenize
+    encoding = get_encoding()
+    token_lists = encoding.encode_ordinary_batch([c['content'] for c in processed_chunks])
+    for chunk_dict, tokens in zip(processed_chunks, token_lists):
+        chunk_dict['metadata']['token_count'] = len(tokens)
+    
     return processed_chunks
 
 
+def chunk_text_tokens(text: str,
+                      chunk_tokens: int = 256,
+                      overlap: int = 50,
+                      min_chunk_tokens: int = 25,
+                      page_spans: list[dict] = None,
+                      model: str = None,
+                      num_threads: int = 8) -> list[dict]:
+    """
+    Chunk text to exact token budgets using the embedding model's tokenizer.
+    
+    The corpus is encoded once, line by line, with tiktoken's batched
+    multi-threaded encoder. Chunks are cut from the resulting token stream,
+    snapping to line boundaries where that keeps at least half the budget.
+    
+    Args:
+        text (str): Input text to chunk
+        chunk_tokens (int): Maximum number of tokens in each chunk
+        overlap (int): Number of tokens to overlap between chunks
+        min_chunk_tokens (int): Minimum number of tokens for any chunk
+        page_spans (list[dict]): Page spans from extract_text_pdfminer
+        model (str): Model whose tokenizer is used (default: EMBED_MODEL)
+        num_threads (int): Threads used by the batched encoder
+        
+    Returns:
+        list[dict]: List of chunks with metadata, including 'token_count'
+    """
+    if overlap >= chunk_tokens:
+        raise ValueError("overlap must be smaller than chunk_tokens")
+        
+    encoding = get_encoding(model)
+    
+    # Lines keep their newline so the per-line encodings decode back to the
+    # whole text. The token stream can differ slightly from encoding the text
+    # in one go (e.g. a blank line's "\n\n" is a single token there).
+    lines = text.splitlines(keepends=True)
+    line_tokens = encoding.encode_ordinary_batch(lines, num_threads=num_threads)
+    
+    tokens = []
+    tok_bounds = [0]
+    for line_toks in line_tokens:
+        tokens.extend(line_toks)
+        tok_bounds.append(len(tokens))
+    total = len(tokens)
+    
+    # Character offset of every token position. Byte-level tokens can split a
+    # multi-byte UTF-8 character, so only positions where a new character
+    # starts (no leading continuation byte) are clean cut points.
+    char_at = [0]
+    clean = []
+    for token in tokens:
+        token_bytes = encoding.decode_single_token_bytes(token)
+        clean.append((token_bytes[0] & 0xC0) != 0x80)
+        char_at.append(char_at[-1] + sum((b & 0xC0) != 0x80 for b in token_bytes))
+    clean.append(True)
+    
+    page_starts = [span['start_char'] for span in page_spans or []]
+    
+    processed_chunks = []
+    start = 0
+    i = 0
+    while start < total:
+        end = min(start + chunk_tokens, total)
+        if end < total:
+            # Prefer ending on a line boundary
+            j = bisect.bisect_right(tok_bounds, end) - 1
+            if tok_bounds[j] >= start + chunk_tokens // 2:
+                end = tok_bounds[j]
+            # Never cut inside a character
+            while end > start + 1 and not clean[end]:
+                end -= 1
+            while not clean[end]:
+                end += 1
+                
+        start_char = char_at[start]
+        
+        window = tokens[start:end]
+        if len(window) >= min_chunk_tokens:
+            chunk = text[start_char:char_at[end]]
+            processed_chunks.append({
+                'content': chunk,
+                'metadata': {
+                    'chunk_id': i,
+                    'char_length': len(chunk),
+                    'token_count': len(window),
+                    'start_char': start_char,
+                    'end_char': start_char + len(chunk),
+                    **chunk_pages(page_spans, page_starts, start_char, start_char + len(chunk)),
+                    **detect_sections(chunk)
+                }
+            })
+        i += 1
+        
+        if end == total:
+            break
+            
+        # Step back by the overlap, starting on a line boundary if one falls inside it
+        next_start = end - overlap
+        j = bisect.bisect_left(tok_bounds, next_start)
+        if tok_bounds[j] < end:
+            next_start = tok_bounds[j]
+        # Widen the overlap rather than leave a tail too short to keep
+        next_start = min(next_start, total - min_chunk_tokens)
+        while not clean[next_start]:
+            next_start -= 1
+        start = next_start if next_start > start else end
+    
+    return processed_chunks
+
+
+def detect_sections(chunk: str) -> dict:
+    """Detect if a chunk contains special sections."""
+    return {
+        'contains_table': bool(re.search(r'table|figure|fig\.', chunk.lower())),
+        'contains_list': bool(re.search(r'^\s*[-•*]\s|^\s*\d+\.\s', chunk, re.MULTILINE)),
+        'is_header': bool(re.search(r'^[A-Z\s]{5,}$', chunk, re.MULTILINE))
+    }
+
+
+def find_page_span(page_spans: list[dict], page_starts: list[int], start_char: int):
+    """Return the page span a character offset falls on, or None if pages are unknown."""
+    if not page_starts:
+        return None
+    return page_spans[max(bisect.bisect_right(page_starts, start_char) - 1, 0)]
+
+
+def chunk_pages(page_spans: list[dict], page_starts: list[int], start_char: int, end_char: int) -> dict:
+    """Source file and first/last page of the text between two offsets."""
+    span = find_page_span(page_spans, page_starts, start_char)
+    if span is None:
+        return {'source': None, 'page': None, 'last_page': None}
+    last_span = find_page_span(page_spans, page_starts, max(end_char - 1, start_char))
+    # A chunk running into the next volume stays within its own volume's pages
+    last_page = last_span['page'] if last_span['source'] == span['source'] else span['page']
+    return {'source': span['source'], 'page': span['page'], 'last_page': last_page}
+
+
 
 
 # 3. Embed Chunks via OpenAI's API
@@ -247,9 +428,29 @@ MAX_TOKENS = 300000
 #         return None
 
 import tiktoken
+import time
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = None):
+    return tiktoken.encoding_for_model(model or EMBED_MODEL)
+
 def count_tokens(text: str, model: str = EMBED_MODEL) -> int:
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
+    return len(get_encoding(model).encode(text))
+
+def chunk_token_counts(chunks: list[dict]) -> list[int]:
+    """Token counts for chunks, from metadata where the chunker stored them.
+    
+    Chunks without a stored count (e.g. from an older chunks.pkl) are
+    encoded together in a single batched call.
+    """
+    counts = [chunk.get('metadata', {}).get('token_count') for chunk in chunks]
+    missing = [i for i, count in enumerate(counts) if count is None]
+    if missing:
+        token_lists = get_encoding().encode_ordinary_batch([chunks[i]['content'] for i in missing])
+        for i, tokens in zip(missing, token_lists):
+            counts[i] = len(tokens)
+    return counts
 
 def embed_chunks(chunks: list[dict]) -> list[list[float]]:
     try:
@@ -257,10 +458,7 @@ def embed_chunks(chunks: list[dict]) -> list[list[float]]:
         batch = []
         token_count = 0
 
-        for chunk in chunks:
-            text = chunk["content"]
-            tokens = count_tokens(text)
-
+        for chunk, tokens in zip(chunks, chunk_token_counts(chunks)):
             if token_count + tokens > MAX_TOKENS:
                 # Send current batch
                 response = openai.Embedding.create(
@@ -297,10 +495,103 @@ def embed_chunks(chunks: list[dict]) -> list[list[float]]:
 import faiss, pickle
 import numpy as np
 
+# Bit flags for the per-chunk metadata bitmap
+FLAG_TABLE = 1
+FLAG_LIST = 2
+FLAG_HEADER = 4
+
+FLAG_BITS = {
+    'contains_table': FLAG_TABLE,
+    'contains_list': FLAG_LIST,
+    'is_header': FLAG_HEADER,
+}
+
+
+def build_chunk_filters(chunks: list[dict]) -> dict:
+    """Pack chunk metadata into compact arrays indexed by FAISS id.
+    
+    Args:
+        chunks: List of chunks, in the order they were added to the index
+        
+    Returns:
+        dict with 'flags' (uint8 bitmask of FLAG_*), 'source_ids' (int16,
+        -1 if unknown), 'pages' and 'last_pages' (int32 first and last page
+        of each chunk, -1 if unknown) and 'sources' (list of source file
+        names indexed by source id)
+    """
+    n = len(chunks)
+    flags = np.zeros(n, dtype="uint8")
+    source_ids = np.full(n, -1, dtype="int16")
+    pages = np.full(n, -1, dtype="int32")
+    last_pages = np.full(n, -1, dtype="int32")
+    sources = []
+    
+    for i, chunk in enumerate(chunks):
+        meta = chunk.get('metadata', {})
+        for key, bit in FLAG_BITS.items():
+            if meta.get(key):
+                flags[i] |= bit
+        if meta.get('source') is not None:
+            if meta['source'] not in sources:
+                sources.append(meta['source'])
+            source_ids[i] = sources.index(meta['source'])
+        if meta.get('page') is not None:
+            pages[i] = meta['page']
+            last_pages[i] = meta.get('last_page') or meta['page']
+            
+    return {'flags': flags, 'source_ids': source_ids, 'pages': pages,
+            'last_pages': last_pages, 'sources': sources}
+
+
+def save_chunk_filters(filters: dict, filter_path="chunk_filters.npz"):
+    np.savez(filter_path,
+             flags=filters['flags'],
+             source_ids=filters['source_ids'],
+             pages=filters['pages'],
+             last_pages=filters['last_pages'],
+             sources=np.array(filters['sources'], dtype=str))
+
+
+def load_chunk_filters(filter_path="chunk_filters.npz", chunks: list[dict] = None) -> dict:
+    """Load precomputed chunk filters, rebuilding them from chunks if missing.
+    
+    Filters that do not match the loaded chunks (e.g. left over from another
+    build) are rebuilt from chunks and saved again.
+    """
+    filters = None
+    if os.path.exists(filter_path):
+        data = np.load(filter_path)
+        if 'last_pages' not in data.files:
+            print(f"{filter_path} predates last-page filtering; rebuilding chunk filters")
+        else:
+            filters = {
+                'flags': data['flags'],
+                'source_ids': data['source_ids'],
+                'pages': data['pages'],
+                'last_pages': data['last_pages'],
+                'sources': data['sources'].tolist(),
+            }
+        if filters is not None and chunks is not None and len(filters['flags']) != len(chunks):
+            print(f"{filter_path} has {len(filters['flags'])} entries but there are "
+                  f"{len(chunks)} chunks; rebuilding chunk filters")
+            filters = None
+            
+    if filters is None:
+        filters = build_chunk_filters(chunks or [])
+        if chunks:
+            save_chunk_filters(filters, filter_path)
+            
+    if len(filters['pages']) and not (filters['pages'] >= 1).any():
+        print("No chunk has source/page data; rebuild the index to filter by volume or page")
+        
+    return filters
+
+
 def build_and_save_faiss(embeddings: list[list[float]],
                          chunks: list[str],
                          index_path="faiss.index",
-                         meta_path="chunks.pkl"):
+                         meta_path="chunks.pkl",
+                         filter_path="chunk_filters.npz"):
     """Build and save a FAISS index from embeddings.
     
     Args:
@@ -308,6 +599,7 @@ def build_and_save_faiss(embeddings: list[list[float]],
         chunks: List of text chunks
         index_path: Path to save FAISS index
         meta_path: Path to save chunk metadata
+        filter_path: Path to save the packed metadata filter arrays
         
     Returns:
         FAISS index object
@@ -330,6 +622,7 @@ def build_and_save_faiss(embeddings: list[list[float]],
     faiss.write_index(index, index_path)
     with open(meta_path, "wb") as f:
         pickle.dump(chunks, f)
+    save_chunk_filters(build_chunk_filters(chunks), filter_path)
         
     return index
 
@@ -343,21 +636,206 @@ def load_faiss(index_path="faiss.index", meta_path="chunks.pkl"):
 
 
 # 6. Retrieve Top-K Chunks for a Query
+def filter_mask(filters: dict, where: dict) -> np.ndarray:
+    """Evaluate a filter expression against the packed chunk filters.
+    
+    Args:
+        filters: Arrays from build_chunk_filters / load_chunk_filters
+        where: Filter expression; every given key must match. Supported keys:
+            'contains_table', 'contains_list', 'is_header' (bool),
+            'source' (file name or list of file names) and
+            'pages' ((first, last) inclusive page range; chunks that
+            overlap it match)
+            e.g. {'contains_table': True} for tables only, or
+            {'source': 'NBC 2016-VOL.2.pdf.pdf', 'pages': (100, 300)}
+            
+    Returns:
+        Boolean array with one entry per chunk id
+    
+    Raises:
+        ValueError: If the expression uses an unknown key or source, or a
+            malformed page range
+    """
+    mask = np.ones(len(filters['flags']), dtype=bool)
+    
+    for key, value in where.items():
+        if key in FLAG_BITS:
+            has_flag = (filters['flags'] & FLAG_BITS[key]) != 0
+            mask &= has_flag if value else ~has_flag
+        elif key == 'source':
+            names = [value] if isinstance(value, str) else list(value)
+            unknown = [n for n in names if n not in filters['sources']]
+            if unknown:
+                raise ValueError(f"Unknown source: {', '.join(unknown)}")
+            wanted = [filters['sources'].index(n) for n in names]
+            mask &= np.isin(filters['source_ids'], wanted)
+        elif key == 'pages':
+            if (not isinstance(value, (tuple, list)) or len(value) != 2
+                    or not all(isinstance(p, (int, np.integer)) for p in value)
+                    or value[0] > value[1]):
+                raise ValueError(f"'pages' must be a (first, last) page range, got {value!r}")
+            first, last = value
+            mask &= (filters['pages'] >= 1) & (filters['pages'] <= last) & (filters['last_pages'] >= first)
+        else:
+            raise ValueError(f"Unknown filter key: {key}")
+            
+    return mask
+
+
 def retrieve(question: str,
              index,
-             chunks: list[str],
-             top_k: int = 5) -> list[str]:
+             chunks: list[dict],
+             top_k: int = 5,
+             where: dict = None,
+             filters: dict = None,
+             return_distances: bool = False) -> Union[list[dict], tuple[list[dict], list[float]]]:
+    """Retrieve the top_k chunks closest to a question.
+    
+    Args:
+        question: User question
+        index: FAISS index built by build_and_save_faiss
+        chunks: Chunks in index order
+        top_k: Number of chunks to return
+        where: Optional filter expression, see filter_mask
+        filters: Precomputed chunk filters (load_chunk_filters); required with where
+        return_distances: Also return the FAISS distance of each chunk
+        
+    Returns:
+        List of chunks, or a (chunks, distances) tuple if return_distances is True
+    
+    Raises:
+        ValueError: If where is given without filters
+    """
+    if where and filters is None:
+        raise ValueError("Filtered retrieval needs the precomputed chunk filters")
+        
     # embed the query
     q_resp = openai.Embedding.create(model=EMBED_MODEL, input=[question])
     q_vec = np.array([q_resp["data"][0]["embedding"]], dtype="float32")
-    dists, ids = index.search(q_vec, top_k)
-    return [chunks[i] for i in ids[0]]
+    
+    if not where:
+        dists, ids = index.search(q_vec, top_k)
+    else:
+        # Restrict the search itself to matching ids instead of over-fetching
+        mask = filter_mask(filters, where)
+        if not mask.any():
+            return ([], []) if return_distances else []
+        bitmap = np.packbits(mask, bitorder="little")
+        selector = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap))
+        params = faiss.SearchParameters(sel=selector)
+        dists, ids = index.search(q_vec, top_k, params=params)
+        
+    # FAISS pads with -1 when fewer than top_k ids are available
+    hits = [(chunks[i], float(d)) for i, d in zip(ids[0], dists[0]) if i >= 0]
+    if return_distances:
+        return [c for c, _ in hits], [d for _, d in hits]
+    return [c for c, _ in hits]
 
 
 # 7. Prompt the LLM with Context + Question
-def ask_llm(context_chunks: list[str], question: str) -> str:
+MAX_CONTEXT_TOKENS = 6000  # Leaves room for the question and answer in gpt-4's window
+PROMPT_OVERHEAD_TOKENS = 40  # Instructions and separators around the context
+
+# Generation tiers, fastest first. 'api_base' may point a tier at another
+# OpenAI-compatible endpoint (e.g. a local stub when testing).
+MODEL_TIERS = [
+    {'name': 'fast', 'model': 'gpt-3.5-turbo', 'max_prompt_tokens': 3000,
+     'expected_latency': 3.0, 'timeout': 10.0, 'api_base': None},
+    {'name': 'quality', 'model': 'gpt-4', 'max_prompt_tokens': 7000,
+     'expected_latency': 15.0, 'timeout': 60.0, 'api_base': None},
+]
+
+# Squared L2 distance below which the best retrieved chunk is treated as a
+# confident match (OpenAI embeddings are unit length, so distances are 0-4)
+CONFIDENT_DISTANCE = 0.8
+
+# Errors after which the next tier is tried: timeouts, connection
+# failures and server-side (5xx) errors
+FALLBACK_ERRORS = (
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+)
+
+# Per-tier metrics, keyed by tier name
+TIER_METRICS = {}
+
+
+def record_tier_metrics(tier: dict, latency: float, prompt_tokens: int,
+                        completion_tokens: int = 0, timed_out: bool = False,
+                        failed: bool = False):
+    stats = TIER_METRICS.setdefault(tier['name'], {
+        'calls': 0,
+        'timeouts': 0,
+        'errors': 0,
+        'total_latency': 0.0,
+        'max_latency': 0.0,
+        'prompt_tokens': 0,
+        'completion_tokens': 0,
+    })
+    stats['calls'] += 1
+    stats['timeouts'] += int(timed_out)
+    stats['errors'] += int(failed)
+    stats['total_latency'] += latency
+    stats['max_latency'] = max(stats['max_latency'], latency)
+    stats['prompt_tokens'] += prompt_tokens
+    stats['completion_tokens'] += completion_tokens
+
+
+def route_model(prompt_tokens: int,
+                distances: list[float] = None,
+                latency_slo: float = None,
+                tiers: list[dict] = None) -> list[dict]:
+    """Pick the generation tiers to try for a prompt, primary first.
+    
+    Args:
+        prompt_tokens: Token count of the full prompt
+        distances: FAISS distances of the retrieved chunks, best first
+        latency_slo: Latency budget for the answer, in seconds
+        tiers: Tiers to choose from, fastest first (default: MODEL_TIERS)
+        
+    Returns:
+        list[dict]: Tiers whose window fits the prompt, ordered so that the
+        primary tier comes first and the rest serve as fallbacks
+    """
+    tiers = [t for t in (tiers or MODEL_TIERS) if prompt_tokens <= t['max_prompt_tokens']]
+    if not tiers:
+        raise ValueError(f"Prompt of {prompt_tokens} tokens does not fit any model tier")
+        
+    confident = bool(distances) and distances[0] <= CONFIDENT_DISTANCE
+    
+    if confident:
+        # A strong match is a simple lookup: the fastest tier answers it just as well
+        primary = tiers[0]
+    else:
+        # Otherwise use the most capable tier the latency budget allows
+        in_budget = [t for t in tiers if latency_slo is None or t['expected_latency'] <= latency_slo]
+        primary = in_budget[-1] if in_budget else tiers[0]
+        
+    return [primary] + [t for t in tiers if t is not primary]
+
+
+def ask_llm(context_chunks: list[dict], question: str,
+            max_context_tokens: int = MAX_CONTEXT_TOKENS,
+            distances: list[float] = None,
+            latency_slo: float = None,
+            tiers: list[dict] = None) -> str:
     # context = "\n\n".join(context_chunks)
-    texts = [chunk['content'] for chunk in context_chunks]
+    # Never build a prompt larger than the biggest tier's window
+    question_tokens = count_tokens(question)
+    largest_window = max(t['max_prompt_tokens'] for t in (tiers or MODEL_TIERS))
+    max_context_tokens = min(max_context_tokens,
+                             largest_window - question_tokens - PROMPT_OVERHEAD_TOKENS)
+    
+    # Keep the best-ranked chunks that fit the context budget
+    texts = []
+    used = 0
+    for chunk, tokens in zip(context_chunks, chunk_token_counts(context_chunks)):
+        if used + tokens > max_context_tokens:
+            break
+        texts.append(chunk['content'])
+        used += tokens
     context = "\n\n".join(texts)
     prompt = (
         "You are a helpful assistant. "
@@ -365,11 +843,50 @@ def ask_llm(context_chunks: list[str], question: str) -> str:
         f"---\n{context}\n---\n"
         f"**Q:** {question}\n**A:**"
     )
-    resp = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[{"role": "user", "content": prompt}]
-    )
-    return resp.choices[0].message.content.strip()
+    prompt_tokens = used + question_tokens + PROMPT_OVERHEAD_TOKENS
+    
+    # Try the routed tier first, falling back to the others on failure
+    start = time.monotonic()
+    last_error = None
+    routed = route_model(prompt_tokens, distances, latency_slo, tiers)
+    for n, tier in enumerate(routed):
+        timeout = tier['timeout']
+        if latency_slo is not None:
+            remaining = latency_slo - (time.monotonic() - start)
+            if remaining <= 0:
+                break
+            # This tier keeps its own expected latency (or all that remains);
+            # the rest is held back for later tiers that can still finish in it
+            own = min(tier['expected_latency'], remaining)
+            reserve = 0.0
+            for later in routed[n + 1:]:
+                if own + reserve + later['expected_latency'] <= remaining:
+                    reserve += later['expected_latency']
+            timeout = min(timeout, remaining - reserve)
+            
+        tier_start = time.monotonic()
+        try:
+            resp = openai.ChatCompletion.create(
+                model=tier['model'],
+                messages=[{"role": "user", "content": prompt}],
+                request_timeout=timeout,
+                api_base=tier.get('api_base')
+            )
+        except FALLBACK_ERRORS as e:
+            timed_out = isinstance(e, openai.error.Timeout)
+            record_tier_metrics(tier, time.monotonic() - tier_start, prompt_tokens,
+                                timed_out=timed_out, failed=not timed_out)
+            print(f"Model tier '{tier['name']}' failed ({type(e).__name__}), falling back")
+            last_error = e
+            continue
+            
+        usage = resp.get("usage", {})
+        record_tier_metrics(tier, time.monotonic() - tier_start,
+                            usage.get("prompt_tokens", prompt_tokens),
+                            usage.get("completion_tokens", 0))
+        return resp.choices[0].message.content.strip()
+        
+    raise last_error or openai.error.Timeout("Latency budget exhausted before any model tier answered")
 
 
 # 8. Cache Q&A History